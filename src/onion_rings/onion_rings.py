@@ -13,34 +13,93 @@ def pandas_to_onion(df,slices,slicelabels=None):
     :return: a tuple containing the counts and the labels
     """
 
-    df2=df.astype({slice:'category' for slice in slices}) #converts to category type all the slices
-    counts=df2.groupby(slices,observed=False)
-    csize=counts.size()
+    to_cast={slice:'category' for slice in slices if df[slice].dtype.name!='category'} #only converts to category type the slices that are not already categorical
+    df2=df.astype(to_cast) if to_cast else df
+    categories=[df2[slice].cat.categories for slice in slices]
+    # Only the observed combinations are grouped, the missing ones are then filled with zeros
+    # (grouping with observed=False on several categorical columns is much slower)
+    csize=df2.groupby(slices,observed=True).size()
+    full_index=pd.MultiIndex.from_product(categories,names=slices) if len(slices)>1 else categories[0]
+    csize=csize.reindex(full_index,fill_value=0)
     if slicelabels is None: #if no labels are provided, the unique values of each slice will be used
-        slicelabels=[]
-        for i in range(len(slices)):
-            slicelabels.append(list(csize.index.get_level_values(i).categories))
+        slicelabels=[list(c) for c in categories]
     shape=tuple([len(l) for l in slicelabels])
-    counts=np.array(counts.size().tolist()).reshape(shape) #converts the counts to a numpy array
+    counts=csize.to_numpy(copy=False).reshape(shape) #view of the dense (reindexed) counts as a numpy array
     return (counts,slicelabels)
 
 
-def plot_onion_rings(data,labels,shortlabels=None, basecolormap="tab10",plot_threshold = 0.02,fontsize=7,figsize=(10,10),rel_percent=False):
+def pandas_to_onion_fast(df,slices,slicelabels=None):
+    """
+    Converts a pandas dataframe to a format that can be used by the plot_onion_rings function
+    Same as pandas_to_onion, but the counts are obtained with numpy (np.bincount) instead of a pandas groupby
+    :param df: dataframe to be converted
+    :param slices: Ordered list of columns to be used as slices
+    :param slicelabels: Optional list of lists of labels to be used for each slice. If not provided, the unique values of each slice will be used
+    :return: a tuple containing the counts and the labels
+    """
+
+    codes=[]
+    categories=[]
+    for slice in slices:
+        if df[slice].dtype.name=='category': #categorical slices keep their categories (and their order)
+            codes.append(df[slice].cat.codes.to_numpy())
+            categories.append(df[slice].cat.categories)
+        else: #other slices use their sorted unique values, as when converted to category type
+            slice_codes,slice_categories=pd.factorize(df[slice],sort=True)
+            codes.append(slice_codes)
+            categories.append(slice_categories)
+    shape=tuple([len(c) for c in categories])
+    codes=np.stack(codes).astype(np.intp)
+    observed=np.all(codes>=0,axis=0) #missing values have code -1 and are ignored, as in a groupby
+    if not observed.all():
+        codes=codes[:,observed]
+    flat_index=np.ravel_multi_index(tuple(codes),shape) #position of each row in the flattened array of counts
+    counts=np.bincount(flat_index,minlength=int(np.prod(shape))).reshape(shape)
+    if slicelabels is None: #if no labels are provided, the unique values of each slice will be used
+        slicelabels=[list(c) for c in categories]
+    return (counts,slicelabels)
+
+
+def _alphas_per_level(items_per_level,low_alpha=0.4):
+    """
+    Computes the alphas used at each level of the onion ring: the range of alphas of each node is split among its children
+    :param items_per_level: number of nodes at each level of the tree
+    :param low_alpha: lowest end of alphas to use
+    :return: a list containing, for each level, an array of alphas (one per node below a given base color)
+    """
+    alpha_per_level = [None]*len(items_per_level)
+    alpha_per_level[0] = np.ones(1) # base colors are used as is at the first level
+    alpha_range = np.array([1.0,low_alpha]) # boundaries of the ranges of alphas to split at the next level
+
+    for level in range(1,len(items_per_level)):
+        nb_items = int(items_per_level[level])
+        # The following splits all the ranges of alphas at the previous level in the appropriate number of items at once
+        deltas = (alpha_range[:-1]-alpha_range[1:])/(nb_items+1)
+        new_alphas = alpha_range[:-1,None] - deltas[:,None]*np.arange(1,nb_items+2)[None,:]
+        alpha_per_level[level] = new_alphas[:,0:-1].ravel() # the last alpha of each range is the start of the next one
+        alpha_range = np.append(alpha_per_level[level],low_alpha)
+
+    return alpha_per_level
+
+
+def plot_onion_rings(data,labels,shortlabels=None, basecolormap="tab10",plot_threshold = 0.02,fontsize=7,figsize=(10,10),rel_percent=False,dtype=np.float64,ax=None):
     """
     Plots onion rings based on hierachical data represented by a balanced tree
     Unbalanced tree will be handled in future versions
     
    :param data: nested list in which each level of nesting corresponds to a node/leaf in the tree.
                 only the leafs should be populated, the numbers are automatically aggregated, OR
-                a pandas dataframe, in which case the function pandas_to_onion is called to convert it to the appropriate format
+                a pandas dataframe, in which case the function pandas_to_onion_fast is called to convert it to the appropriate format
    :param labels: nested list containing the labels to be used at each level, OR
-                  a list of strings, in which case the function pandas_to_onion is called to convert it to the appropriate format.
+                  a list of strings, in which case the function pandas_to_onion_fast is called to convert it to the appropriate format.
                   The list of string is assumed to be the list of columns of the dataframe and used  with pandas groupby to generate the data
     :param basecolormap (optional): base colors to be used to plot the data (default is "tab10") see https://matplotlib.org/stable/users/explain/colors/colormaps.html
     :param plot_threshold (optional): threshold (percentage, e.g. 0.02) below which labels are not included (default is 0.02)
     :param fontsize (optional): fontsize of the labels (default is 7)
     :param figsize (optional): size of the figure (default is (10,10))
     :param rel_percent (optional): if True, the labels will be expressed in terms of relative percentage of the total (default is False)
+    :param dtype (optional): floating point type used to aggregate the data, np.float32 halves the memory used by large trees (default is np.float64)
+    :param ax (optional): polar axes on which to plot, cleared before plotting, e.g. to redraw repeatedly on the same figure. If None, a new figure is created (default is None)
     
     Example: tree of depth three with two leaves in each branch (8 leaves total)
       data = [[[1,3],[1,1]],[[4,5],[1,1]]]
@@ -52,133 +111,105 @@ def plot_onion_rings(data,labels,shortlabels=None, basecolormap="tab10",plot_thr
       plot_onion_rings(pandas_df,['ColInd1','ColInd2','ColInd3']) #where pandas_df is a pandas dataframe and ColInd1, ColInd2, ColInd3 are the columns to be used as slices. Slice labels will be the unique values of each column.
     """
     if type(data) == pd.core.frame.DataFrame: #if the data is a pandas dataframe, it is first converted to the appropriate format
-        onion_data=pandas_to_onion(data,labels, slicelabels=shortlabels)
+        onion_data=pandas_to_onion_fast(data,labels, slicelabels=shortlabels)
         data=onion_data[0]
         labels=onion_data[1]
 
     basemap = plt.colormaps[basecolormap] #loads base colormap
     NUMBER_BASE = basemap.N # number of lements in the colormap
 
-    data_array = np.array(data) # converts data in numpy array form
+    data_array = np.asarray(data) # converts data in numpy array form
+    integer_data = np.issubdtype(data_array.dtype,np.integer) # integer counts are displayed as integers in the labels
+    data_array = np.ascontiguousarray(data_array,dtype=dtype) # contiguous floating point array so that all reductions use the fast path
     NUMBER_ITEMS_PER_LEVEL = np.array(np.shape(data_array)) # number of nodes at each level of the tree
     NUMBER_LEVELS = NUMBER_ITEMS_PER_LEVEL.size # number of levels
 
     # Creation of colors to be used at each level of the onion ring
     # Each nesting levels decreases the alpha
-    my_map = []
-    for i in np.arange(NUMBER_ITEMS_PER_LEVEL[0]):
-        my_map.append(list(basemap(np.mod(i,NUMBER_BASE)))) # adds base colors to the map, cycling if necessary
-
-    alpha_range = [[1.0,0.4]] # range of alpha to split in the new colormap
-    low_alpha_range = alpha_range[0][1] # lowest end of alphas to use ()
-
-    alpha_per_level = [[1]] # initialization of list of alphas per level
-
-    for level in np.arange(1,NUMBER_LEVELS): # creating list of alphas per level
-        nb_items = NUMBER_ITEMS_PER_LEVEL[level]
-        level_alpha = []
-        for i in np.arange(0,len(alpha_range[level-1])):
-            # The following splits the range of alphas at the previous level in the appropriate number of items
-            if alpha_range[level-1][i] >low_alpha_range:
-                delta = (alpha_range[level-1][i]-alpha_range[level-1][i+1])/(nb_items+1)
-                new_alphas = list(alpha_range[level-1][i] - delta*np.arange(1,nb_items+2))
-                alpha_range.append(new_alphas)
-                for new_alpha in new_alphas[0:-1]:
-                    level_alpha.append(new_alpha)
-        alpha_per_level.append(level_alpha)
+    my_map = basemap(np.arange(NUMBER_ITEMS_PER_LEVEL[0]) % NUMBER_BASE) # (number of base colors, 4) array of RGBA values, cycling if necessary
+
+    alpha_per_level = _alphas_per_level(NUMBER_ITEMS_PER_LEVEL) # list of alphas per level
 
     # Creation of color map
-    my_level_map = []
-    NUMBER_CUM_ITEMS_PER_LEVEL = np.cumprod(NUMBER_ITEMS_PER_LEVEL)/NUMBER_ITEMS_PER_LEVEL[0] # Computes the indexing in the colormap
+    # For each level, every base color is repeated with each of the alphas of that level (outer product base colors x alphas)
+    NUMBER_NODES_PER_LEVEL = np.cumprod(NUMBER_ITEMS_PER_LEVEL) # number of nodes (i.e., of colors) at each level
+    NODE_INDEX_PER_LEVEL = np.concatenate(([0],np.cumsum(NUMBER_NODES_PER_LEVEL))) # position of the nodes of each level in the color map and in the arrays of values
+    my_level_map = np.empty((NODE_INDEX_PER_LEVEL[-1],4))
+    my_level_map[0:NODE_INDEX_PER_LEVEL[1]] = my_map # first level uses the base colors as is
 
-    for level in np.arange(NUMBER_LEVELS):
-        for base_color in my_map:
-            if level==0:
-                my_level_map.append(base_color) # appends base colors to first level
-            else:
-                for item in np.arange(int(NUMBER_CUM_ITEMS_PER_LEVEL[level])): # adds modified alphas to the color map using alpha_per_level
-                    new_color = base_color[0:3]
-                    alpha = alpha_per_level[level][item]
-                    new_color.append(alpha)
-                    my_level_map.append(new_color)
+    for level in range(1,NUMBER_LEVELS):
+        level_rgba = my_level_map[NODE_INDEX_PER_LEVEL[level]:NODE_INDEX_PER_LEVEL[level+1]].reshape(my_map.shape[0],-1,4) # view on the colors of the level
+        level_rgba[...,0:3] = my_map[:,None,0:3]
+        level_rgba[...,3] = alpha_per_level[level][None,:]
 
 
     # Creation of polar plot to represent data
     # Credit where it's due: https://matplotlib.org/stable/gallery/pie_and_polar_charts/nested_pie.html
 
-    fig, ax = plt.subplots(subplot_kw=dict(projection="polar"), figsize=figsize) # figure and axes
+    if ax is None:
+        fig, ax = plt.subplots(subplot_kw=dict(projection="polar"), figsize=figsize) # figure and axes
+    else: # reuses the provided (polar) axes and its figure
+        fig = ax.figure
+        ax.clear()
     SIZE = 1.0/(NUMBER_LEVELS+1) # width of onion ring (using +1 leaves a nice hold in the middle)
+    PI = np.pi
+    TWO_PI = 2.0*np.pi
 
-    values_normalized = data_array/np.sum(data_array) # Normalize data_array values to [0,1]
-    values_in_angles = values_normalized*2*np.pi # Normalize data_array values to [0,2pi]
+    total = np.sum(data_array) # total of all leaves, reused at every level
 
     # Computes boundaries and values of different levels
-    # This is merely data re-formatting to ensure that we can read all required value sequentially in a list per level
-    width_values_at_level = []
-    original_values_at_level = []
-    percent_values_at_level = []
-    rel_percent_values_at_level = []
-    edge_values_at_level = []
-
-    for level in np.arange(NUMBER_LEVELS-1,-1,-1):
-        if level == NUMBER_LEVELS-1:
-            hierachical_values_in_angle = values_in_angles
-            hierarchical_original_values = data_array
-            hierarchical_percent_values = values_normalized
-            outersums=np.expand_dims(np.sum(data_array,axis=-1),axis=-1)
-            hierarchical_rel_percent_values = data_array/outersums
-            #hierarchical_percent_values = data_array/outersums #Temporary test
-        else:
-            hierachical_values_in_angle = hierachical_values_in_angle.sum(axis=level+1)
-            hierarchical_original_values = hierarchical_original_values.sum(axis=level+1)
-            hierarchical_percent_values = hierarchical_percent_values.sum(axis=level+1)
-            data_array_temp=np.sum(data_array,axis=tuple(range(level+1,NUMBER_LEVELS)))
-            outersums_temp=np.expand_dims(np.sum(data_array_temp,axis=-1),axis=-1)
-            hierarchical_rel_percent_values = data_array_temp/outersums_temp
-            #hierarchical_percent_values = data_array_temp/outersums_temp #Temporary test
-        edge_values_at_level.insert(0,np.cumsum(np.append(0, hierachical_values_in_angle.flatten()[:-1])))
-        width_values_at_level.insert(0,hierachical_values_in_angle.flatten())
-        original_values_at_level.insert(0,hierarchical_original_values.flatten())
-        rel_percent_values_at_level.insert(0,hierarchical_rel_percent_values.flatten())
-        percent_values_at_level.insert(0,hierarchical_percent_values.flatten())
-
-    # Plots layers of the onion
-    for level in np.arange(NUMBER_LEVELS):
-        # Extracts the colormap for the level
-        if level ==0 :
-            start_color_index = 0
-            stop_color_index = start_color_index + NUMBER_ITEMS_PER_LEVEL[level]
-        else:
-            start_color_index = stop_color_index
-            stop_color_index  = start_color_index + np.prod(np.array(NUMBER_ITEMS_PER_LEVEL)[0:level+1])
-        colors_level = my_level_map[start_color_index:stop_color_index]
-        # Plots the layer
-        ax.bar(x=edge_values_at_level[level],
-               width=width_values_at_level[level],
-               bottom=2*SIZE+level*2*SIZE,
-               height=2*SIZE,
-               color=colors_level,
-               edgecolor='w',
-               linewidth=1,
-               align="edge")
-
+    # All levels are stored one after the other (innermost level first) in the same arrays, the values of a level are read through a slice
+    LEVEL_SLICES = [slice(NODE_INDEX_PER_LEVEL[level],NODE_INDEX_PER_LEVEL[level+1]) for level in range(NUMBER_LEVELS)]
+    original_values = np.empty(NODE_INDEX_PER_LEVEL[-1],dtype=data_array.dtype)
+    rel_percent_values = np.empty_like(original_values)
+
+    # Only the original values are aggregated, each level being obtained from the previous (deeper) one
+    hierarchical_original_values = data_array
+    for level in range(NUMBER_LEVELS-1,-1,-1):
+        if level < NUMBER_LEVELS-1:
+            # Aggregates the previous (deeper) level over its last axis, touching each element only once
+            hierarchical_original_values = hierarchical_original_values.sum(axis=-1)
+        outersums = hierarchical_original_values.sum(axis=-1,keepdims=True)
+        original_values[LEVEL_SLICES[level]] = hierarchical_original_values.ravel()
+        np.divide(hierarchical_original_values,outersums,out=rel_percent_values[LEVEL_SLICES[level]].reshape(hierarchical_original_values.shape))
+
+    percent_values = original_values/total # Normalize values to [0,1]
+    width_values = percent_values*TWO_PI # Normalize values to [0,2pi]
+    edge_values = np.empty_like(width_values) # edges of a level are the cumulative sums of its widths, starting at 0
+    for level_slice in LEVEL_SLICES:
+        edge_values[level_slice.start] = 0.0
+        np.cumsum(width_values[level_slice][:-1],out=edge_values[level_slice][1:])
+    if integer_data:
+        original_values = np.rint(original_values).astype(np.int64)
+
+    # Plots all layers of the onion in a single call, the colors of the color map are already ordered level by level
+    ax.bar(x=edge_values,
+           width=width_values,
+           bottom=np.repeat(2*SIZE+np.arange(NUMBER_LEVELS)*2*SIZE,NUMBER_NODES_PER_LEVEL),
+           height=2*SIZE,
+           color=my_level_map,
+           edgecolor='w',
+           linewidth=1,
+           align="edge")
+
+    for level in range(NUMBER_LEVELS):
         # Prints labels
-        region_edges = edge_values_at_level[level]
-        for i in np.arange(len(region_edges)):
-            if i< len(region_edges)-1:
-                angle = (region_edges[i]+region_edges[i+1])*0.5
-            else:
-                angle = (region_edges[len(region_edges)-1]+2*np.pi)*0.5
-            if angle>np.pi:
-                text_rotation=0
-            else:
-                text_rotation = angle+180
-            if percent_values_at_level[level][i]>plot_threshold:
-                if rel_percent:
-                    current_label = labels[level][np.mod(i,NUMBER_ITEMS_PER_LEVEL[level])] + "\n"+str(np.round(rel_percent_values_at_level[level][i]*100,1))+"%\n({})".format(original_values_at_level[level][i])
-                else:
-                    current_label = labels[level][np.mod(i,NUMBER_ITEMS_PER_LEVEL[level])] + "\n"+str(np.round(percent_values_at_level[level][i]*100,1))+"%\n({})".format(original_values_at_level[level][i])
-                plt.text(angle,3*SIZE+level*2*SIZE,current_label,size=fontsize  ,ha='center',va='center',color='white',weight='bold',rotation=text_rotation, rotation_mode='anchor',transform_rotates_text=True)
+        # Labels are only built for wedges above the threshold, levels without any such wedge are skipped altogether
+        labeled_wedges = np.flatnonzero(percent_values[LEVEL_SLICES[level]]>plot_threshold)
+        if labeled_wedges.size == 0:
+            continue
+        angles = edge_values[LEVEL_SLICES[level]]+0.5*width_values[LEVEL_SLICES[level]] # middle of each wedge
+        text_rotations = np.where(angles>PI,0.0,angles+180)
+        if rel_percent:
+            label_percent_values = rel_percent_values[LEVEL_SLICES[level]]
+        else:
+            label_percent_values = percent_values[LEVEL_SLICES[level]]
+        nb_items_level = int(NUMBER_ITEMS_PER_LEVEL[level])
+        label_radius = 3*SIZE+level*2*SIZE
+        label_names = np.asarray(labels[level],dtype=object)[labeled_wedges % nb_items_level] # names of the labeled wedges, looked up at once
+        current_labels = [name + "\n"+str(round(percent*100.0,1))+"%\n({})".format(original) for name,percent,original in zip(label_names,label_percent_values[labeled_wedges],original_values[LEVEL_SLICES[level]][labeled_wedges])]
+        for i,current_label in zip(labeled_wedges.tolist(),current_labels):
+            ax.text(angles[i],label_radius,current_label,size=fontsize  ,ha='center',va='center',color='white',weight='bold',rotation=text_rotations[i], rotation_mode='anchor',transform_rotates_text=True)
 
     ax.set_axis_off()
 